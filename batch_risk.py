@@ -0,0 +1,308 @@
+"""
+Overnight batch runner that computes the portfolio yield, DV01 and VaR figures
+for many client portfolios at once.
+
+The market data is queried from the SQL database once, pivoted into
+(trade_date x cusip) arrays and copied into shared memory blocks. Each worker process
+in the pool maps those blocks when it starts rather than receiving its own copy, and
+then evaluates its chunks of portfolios as matrix operations: the weight matrix
+(portfolio x cusip) multiplied by the pivoted data gives the same series as
+create_portfolio for every portfolio in the chunk.
+
+Portfolios holding a cusip with no market data are reported with a warning and given
+NaN risk figures, and missing_market_data set. A date range with no market data at all
+does the same for every portfolio.
+
+The portfolios file is either a csv with the columns portfolio, cusip, weight
+or a json file of {portfolio: {cusip: weight}}.
+
+Example:
+    poetry run python batch_risk.py portfolios.csv --output portfolio_risk.parquet
+"""
+
+import argparse
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from database_creation import DATABASE_URL, date_to_int, ints_to_dates
+from webpage.calculations import CovarianceEstimator, pivot_returns
+
+# market data arrays, set once per worker process by init_worker as views
+# onto the shared memory blocks created by run_batch
+MARKET_DATA: dict = {}
+SHARED_BLOCKS: list[shared_memory.SharedMemory] = []
+
+RESULT_COLUMNS = [
+    "portfolio",
+    "ytm",
+    "close_price",
+    "dv01",
+    "historical_var",
+    "var_covar",
+    "weights_valid",
+    "missing_market_data",
+    "chunk_elapsed_ms_avg",
+    "as_of_date",
+    "confidence_level",
+]
+
+
+def load_portfolios(path: str) -> pd.DataFrame:
+    """loads the portfolios file as a (portfolio x cusip) weight matrix"""
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as file:
+            portfolios = json.load(file)
+        weights_df = pd.DataFrame(portfolios).T
+    elif os.path.getsize(path) == 0:
+        weights_df = pd.DataFrame()
+    else:
+        weights_df = pd.read_csv(path, dtype={"portfolio": str, "cusip": str})
+        weights_df = weights_df.pivot_table(
+            index="portfolio", columns="cusip", values="weight", aggfunc="sum"
+        )
+    weights_df.index.name = "portfolio"
+    return weights_df.astype(float).fillna(0.0)
+
+
+def load_market_data(
+    cusips: list[str], start_date: str | None = None, end_date: str | None = None
+) -> dict[str, pd.DataFrame]:
+    """queries the yield, price and dv01 data once and pivots it into (trade_date x cusip) frames"""
+    cusip_list = ", ".join(f"'{cusip}'" for cusip in cusips)
+    date_filter = ""
+    if start_date is not None:
+        date_filter += f" and t.date_int >= {date_to_int(start_date)}"
+    if end_date is not None:
+        date_filter += f" and t.date_int <= {date_to_int(end_date)}"
+
+    tick_df = pd.read_sql(
+        f"""select s.cusip, t.ytm, t.close_price, t.date_int from tick_history t
+        join securities s on s.security_id = t.security_id
+        where s.cusip in ({cusip_list}){date_filter}""",
+        DATABASE_URL,
+    )
+    dv01_df = pd.read_sql(
+        f"""select s.cusip, t.dv01, t.date_int from dv01_info t
+        join securities s on s.security_id = t.security_id
+        where s.cusip in ({cusip_list}){date_filter}""",
+        DATABASE_URL,
+    )
+    for input_df in [tick_df, dv01_df]:
+        input_df["trade_date"] = ints_to_dates(input_df.pop("date_int"))
+
+    # every frame is aligned on the trade dates of tick_history
+    trade_dates = pd.DatetimeIndex(sorted(tick_df["trade_date"].unique()))
+    market_data = {}
+    columns = [("ytm", tick_df), ("close_price", tick_df), ("dv01", dv01_df)]
+    for column, input_df in columns:
+        market_data[column] = (
+            pd.pivot_table(input_df, index="trade_date", columns="cusip", values=column)
+            .reindex(index=trade_dates, columns=cusips)
+            .ffill()
+        )
+    return market_data
+
+
+def share_arrays(
+    arrays: dict[str, np.ndarray]
+) -> tuple[list[shared_memory.SharedMemory], dict]:
+    """copies the arrays into shared memory blocks, returning the blocks (to be
+    unlinked by the caller) and the specs the workers need to map them"""
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def init_worker(specs: dict, confidence_level: float) -> None:
+    """maps the shared market data blocks into the worker process"""
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        SHARED_BLOCKS.append(block)
+        MARKET_DATA[name] = np.ndarray(shape, dtype, buffer=block.buf)
+    MARKET_DATA["confidence_level"] = confidence_level
+
+
+def evaluate_chunk(names: list[str], weights: np.ndarray) -> pd.DataFrame:
+    """evaluates the risk figures for a chunk of portfolios as matrix operations"""
+    start = time.perf_counter()
+    confidence_level = MARKET_DATA["confidence_level"]
+
+    # (portfolio x trade_date) series, same as create_portfolio's Portfolio column
+    yield_series = weights @ MARKET_DATA["ytm"].T
+    price_series = weights @ MARKET_DATA["close_price"].T
+    dv01_series = weights @ MARKET_DATA["dv01"].T
+
+    # both VaRs are of the daily change of the portfolio yield, as on the webpage. The
+    # parametric one weights the constituent returns by each constituent's share of the
+    # last day's portfolio yield
+    if yield_series.shape[1] < 3:
+        # fewer than two days of returns, as on the webpage
+        historical_var = var_covar = np.full(len(names), np.nan)
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            returns = yield_series[:, 1:] / yield_series[:, :-1] - 1
+            exposures = weights * MARKET_DATA["ytm"][-1]
+            var_weights = exposures / exposures.sum(axis=1, keepdims=True)
+        with warnings.catch_warnings():
+            # portfolios with no market data have no returns, their VaR is NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            historical_var = np.nanquantile(returns, 1 - confidence_level, axis=1)
+
+        port_mean = var_weights @ MARKET_DATA["mean"]
+        port_std = np.sqrt(
+            np.einsum("ij,jk,ik->i", var_weights, MARKET_DATA["cov"], var_weights)
+        )
+        var_covar = norm.ppf(1 - confidence_level, port_mean, port_std)
+
+    elapsed = time.perf_counter() - start
+    return pd.DataFrame(
+        {
+            "portfolio": names,
+            "ytm": yield_series[:, -1],
+            "close_price": price_series[:, -1],
+            "dv01": dv01_series[:, -1],
+            "historical_var": historical_var,
+            "var_covar": var_covar,
+            "weights_valid": np.isclose(weights.sum(axis=1), 1.0, atol=1e-04),
+            # the chunk is one matrix operation so only its average time is known
+            "chunk_elapsed_ms_avg": elapsed * 1000 / len(names),
+        }
+    )
+
+
+def missing_results(weights_df: pd.DataFrame, confidence_level: float) -> pd.DataFrame:
+    """NaN results for every portfolio, when there is no market data to evaluate them on"""
+    results_df = pd.DataFrame(np.nan, index=range(len(weights_df)), columns=RESULT_COLUMNS)
+    results_df["portfolio"] = list(weights_df.index)
+    results_df["weights_valid"] = np.isclose(weights_df.sum(axis=1), 1.0, atol=1e-04)
+    results_df["missing_market_data"] = True
+    results_df["as_of_date"] = pd.NaT
+    results_df["confidence_level"] = confidence_level
+    return results_df
+
+
+def run_batch(
+    weights_df: pd.DataFrame,
+    market_data: dict[str, pd.DataFrame],
+    confidence_level: float = 0.99,
+    workers: int | None = None,
+    chunk_size: int = 100,
+) -> pd.DataFrame:
+    """spreads the portfolios across a process pool and collects the results"""
+    if weights_df.empty:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+
+    cusips = list(weights_df.columns)
+    missing_cusips = [
+        cusip for cusip in cusips if market_data["ytm"][cusip].isna().all()
+    ]
+    missing_market_data = weights_df[missing_cusips].ne(0).any(axis=1)
+    if market_data["ytm"].empty:
+        warnings.warn(
+            "no market data in the date range, all portfolios are marked invalid"
+        )
+        return missing_results(weights_df, confidence_level)
+    if missing_cusips:
+        warnings.warn(
+            f"no market data for cusips {missing_cusips}, "
+            f"{missing_market_data.sum()} portfolios hold them and are marked invalid"
+        )
+
+    arrays = {
+        column: np.nan_to_num(market_data[column].to_numpy(dtype=float))
+        for column in ["ytm", "close_price", "dv01"]
+    }
+    arrays["mean"] = np.full(len(cusips), np.nan)
+    arrays["cov"] = np.full((len(cusips), len(cusips)), np.nan)
+    estimator = CovarianceEstimator.from_returns(pivot_returns(market_data["ytm"]))
+    if estimator.num_days >= 2:
+        arrays["mean"] = estimator.mean
+        arrays["cov"] = estimator.cov
+
+    weights = weights_df[cusips].to_numpy(dtype=float)
+    names = list(weights_df.index)
+    chunks = [
+        (names[i : i + chunk_size], weights[i : i + chunk_size])
+        for i in range(0, len(names), chunk_size)
+    ]
+
+    blocks, specs = share_arrays(arrays)
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(specs, confidence_level),
+        ) as executor:
+            results = list(executor.map(evaluate_chunk, *zip(*chunks)))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    results_df = pd.concat(results, ignore_index=True)
+    results_df["missing_market_data"] = missing_market_data.to_numpy()
+    risk_columns = ["ytm", "close_price", "dv01", "historical_var", "var_covar"]
+    results_df.loc[results_df["missing_market_data"], risk_columns] = np.nan
+    results_df["as_of_date"] = market_data["ytm"].index[-1]
+    results_df["confidence_level"] = confidence_level
+    return results_df[RESULT_COLUMNS]
+
+
+def save_results(results_df: pd.DataFrame, output: str) -> None:
+    """writes the results to a parquet file or to a table in the SQL database"""
+    if output.endswith(".parquet"):
+        results_df.to_parquet(output, index=False)
+    else:
+        results_df.to_sql(output, DATABASE_URL, if_exists="replace", index=False)
+
+
+def main() -> None:
+    """compute the nightly risk figures of every portfolio in the portfolios file"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("portfolios", help="csv or json file of portfolio weights")
+    parser.add_argument(
+        "--output",
+        default="portfolio_risk",
+        help="parquet file path or SQL table name for the results",
+    )
+    parser.add_argument("--start-date", default=None)
+    parser.add_argument("--end-date", default=None)
+    parser.add_argument("--confidence-level", type=float, default=0.99)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=100)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    weights_df = load_portfolios(args.portfolios)
+    market_data = {}
+    if not weights_df.empty:
+        market_data = load_market_data(
+            list(weights_df.columns), args.start_date, args.end_date
+        )
+    results_df = run_batch(
+        weights_df,
+        market_data,
+        args.confidence_level,
+        args.workers,
+        args.chunk_size,
+    )
+    save_results(results_df, args.output)
+    print(
+        f"{len(results_df)} portfolios evaluated in {time.perf_counter() - start:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
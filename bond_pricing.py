@@ -0,0 +1,166 @@
+"""
+Vectorized bond pricing for whole arrays of bond-days: the clean price of a bond from
+its yield, the yield from its price, and the reconciliation of the yields and prices
+in tick_history during ingestion.
+
+dv01_calc computes the DV01 from bond_price as well, so the DV01 and the tick
+validation assume the same cash flows: coupons of coupon / coupon_freq per 100 of face
+value paid coupon_freq times a year, with the time to the next coupon taken from the
+time to maturity (years = days / 365).
+"""
+
+import numpy as np
+import numpy_financial as npf  # pylint: disable=import-error
+import pandas as pd
+
+
+def bond_price(
+    ytm: np.ndarray,
+    coupon: np.ndarray,
+    years: np.ndarray,
+    freq: np.ndarray | int = 1,
+    fv: float = 100,
+) -> np.ndarray:
+    """Clean price of whole arrays of bond-days at once.
+    ytm is a decimal annual yield, coupon is the annual coupon per 100 of face value
+    and years is the time to maturity (days / 365)"""
+    rate = ytm / freq
+    pmt = coupon / freq
+    periods = years * freq
+    # time to the next coupon, in periods, and the number of coupons left
+    to_next = periods - np.floor(periods)
+    to_next = np.where(to_next > 0, to_next, 1.0)
+    num_payments = np.ceil(periods)
+
+    # value of the remaining coupons and face value one period before the next coupon
+    with np.errstate(divide="ignore", invalid="ignore"):
+        annuity = -1 * npf.pv(rate=rate, nper=num_payments, pmt=pmt, fv=fv)
+    dirty_price = annuity * (1 + rate) ** (1 - to_next)
+    return dirty_price - pmt * (1 - to_next)
+
+
+def solve_ytm(
+    price: np.ndarray,
+    coupon: np.ndarray,
+    years: np.ndarray,
+    freq: np.ndarray | int = 1,
+    iterations: int = 50,
+    tolerance: float = 1e-8,
+    bounds: tuple[float, float] = (-0.5, 2.0),
+) -> tuple[np.ndarray, dict]:
+    """
+    Solves for the yield of whole arrays of bond-days given their clean prices.
+
+    Every bond-day takes a Newton step (slope from a central difference of bond_price,
+    like calc_dv01) and falls back to bisection whenever the step leaves the bracket that
+    is known to contain the yield. The loop runs over the fixed iteration budget, not over
+    the bonds: each iteration is a handful of array operations on the bond-days that have
+    not converged yet.
+
+    Returns the yields and the convergence statistics of the solve.
+    Yields that did not converge within the budget are NaN.
+    """
+    price, coupon, years = (np.asarray(x, dtype=float) for x in (price, coupon, years))
+    freq = np.broadcast_to(np.asarray(freq, dtype=float), price.shape)
+    step = 1e-6
+
+    # current yield with a pull to par as the initial guess
+    ytm = (coupon + (100 - price) / np.maximum(years, 1 / 365)) / ((100 + price) / 2)
+    ytm = np.clip(np.nan_to_num(ytm), bounds[0] + step, bounds[1] - step)
+    lower = np.full(price.shape, bounds[0])
+    upper = np.full(price.shape, bounds[1])
+    converged = np.zeros(price.shape, dtype=bool)
+    iterations_used = np.full(price.shape, iterations)
+    active = np.flatnonzero(np.isfinite(price))
+
+    for i in range(iterations):
+        args = (coupon[active], years[active], freq[active])
+        guess = ytm[active]
+        error = bond_price(guess, *args) - price[active]
+
+        done = np.abs(error) < tolerance
+        converged[active[done]] = True
+        iterations_used[active[done]] = i
+        active, guess, error = active[~done], guess[~done], error[~done]
+        if active.size == 0:
+            break
+        args = (coupon[active], years[active], freq[active])
+
+        # price falls as yield rises, so a positive error means the yield is too low
+        low = np.where(error > 0, guess, lower[active])
+        high = np.where(error < 0, guess, upper[active])
+        slope = (bond_price(guess + step, *args) - bond_price(guess - step, *args)) / (
+            2 * step
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = guess - error / slope
+        in_bracket = np.isfinite(newton) & (newton > low) & (newton < high)
+
+        lower[active] = low
+        upper[active] = high
+        ytm[active] = np.where(in_bracket, newton, (low + high) / 2)
+
+    residual = np.abs(bond_price(ytm, coupon, years, freq) - price)
+    stats = {
+        "num_rows": int(price.size),
+        "num_converged": int(converged.sum()),
+        "mean_iterations": float(iterations_used[converged].mean())
+        if converged.any()
+        else float("nan"),
+        "max_iterations": int(iterations_used[converged].max())
+        if converged.any()
+        else 0,
+        "max_residual": float(residual[converged].max()) if converged.any() else 0.0,
+    }
+    return np.where(converged, ytm, np.nan), stats
+
+
+def reconcile_ticks(
+    tick_history: pd.DataFrame, cusip_info: pd.DataFrame, price_tolerance: float = 1.0
+) -> tuple[pd.DataFrame, dict]:
+    """
+    Fills the ytm or close_price of ticks missing one of them from the other,
+    and flags ticks whose ytm and close_price disagree by more than price_tolerance
+    (in price points per 100 of face value).
+
+    tick_history has the refinitiv columns (ytm in percent) and cusip_info is indexed by cusip.
+    Returns the reconciled ticks and the solver statistics.
+    """
+    tick_history = tick_history.copy()
+    bonds = cusip_info.reindex(tick_history["cusip"])
+    coupon = bonds["coupon"].to_numpy(dtype=float)
+    freq = bonds["coupon_freq"].to_numpy(dtype=float)
+    years = (
+        (bonds["maturity_date"].to_numpy() - tick_history["trade_date"].to_numpy())
+        / np.timedelta64(1, "D")
+        / 365
+    )
+    ytm = tick_history["ytm"].to_numpy(dtype=float)
+    close_price = tick_history["close_price"].to_numpy(dtype=float)
+
+    model_price = bond_price(ytm / 100, coupon, years, freq)
+    missing_price = np.isnan(close_price) & ~np.isnan(ytm)
+    close_price = np.where(missing_price, model_price, close_price)
+
+    missing_ytm = np.isnan(ytm) & ~np.isnan(close_price)
+    solved_ytm, stats = solve_ytm(
+        close_price[missing_ytm],
+        coupon[missing_ytm],
+        years[missing_ytm],
+        freq[missing_ytm],
+    )
+    ytm[missing_ytm] = solved_ytm * 100
+
+    tick_history["ytm"] = ytm
+    tick_history["close_price"] = close_price
+    tick_history["flagged"] = np.abs(model_price - close_price) > price_tolerance
+    unusable = tick_history[["ytm", "close_price"]].isna().any(axis=1)
+    stats.update(
+        {
+            "prices_filled": int(missing_price.sum()),
+            "yields_filled": int(np.isfinite(solved_ytm).sum()),
+            "ticks_flagged": int(tick_history["flagged"].sum()),
+            "ticks_dropped": int(unusable.sum()),
+        }
+    )
+    return tick_history[~unusable], stats
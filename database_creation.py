@@ -13,10 +13,22 @@ the SQLAlchemy ORM abstractsaway the difference.
 import datetime
 
 import pandas as pd
-from sqlalchemy import Column, DateTime, Float, Integer, String, create_engine
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    String,
+    create_engine,
+    false,
+    text,
+)
 from sqlalchemy.engine.base import Engine
 from sqlalchemy.orm import declarative_base
 
+from bond_pricing import reconcile_ticks
+
 # this database URL can be changed to MS SQL server, MySQL,
 # MariaDB, PostGresSQL, etc.
 # it is a level of abstraction that allows for the same code
@@ -29,15 +41,33 @@ DATABASE_URL = "sqlite:///pharo_assessment.db"
 Base = declarative_base()
 
 
+# trade dates are stored as integer day numbers counted from this epoch
+EPOCH = pd.Timestamp("1970-01-01")
+
+
+class Security(Base):
+    """securities SQL Table schema, the dimension table that maps each CUSIP
+    to the integer surrogate id used as the key of the fact tables"""
+
+    __tablename__ = "securities"
+    security_id = Column(Integer, primary_key=True)
+    cusip = Column(String(50), unique=True, nullable=False)
+
+
 class TickHistory(Base):
-    """tick_history SQL Table schema where the historical yield data is stored"""
+    """tick_history SQL Table schema where the historical yield data is stored
+
+    Rows are keyed on (security_id, date_int) and stored without a rowid so that the
+    table is clustered on that key and a date range scan for a security is contiguous"""
 
     __tablename__ = "tick_history"
-    id = Column(Integer, primary_key=True)
-    cusip = Column(String(50), unique=False, nullable=False)
+    __table_args__ = {"sqlite_with_rowid": False}
+    security_id = Column(Integer, primary_key=True)
+    date_int = Column(Integer, primary_key=True)
     ytm = Column(Float, unique=False, nullable=False)
     close_price = Column(Float, unique=False, nullable=False)
-    trade_date = Column(DateTime, default=datetime.datetime.utcnow)
+    # ytm and close_price disagree according to bond_pricing.reconcile_ticks
+    flagged = Column(Boolean, unique=False, nullable=False, server_default=false())
 
 
 class CusipInfo(Base):
@@ -64,14 +94,202 @@ class DV01(Base):
     """
 
     __tablename__ = "dv01_info"
-    id = Column(Integer, primary_key=True)
-    cusip = Column(String(50), unique=False, nullable=False)
+    __table_args__ = {"sqlite_with_rowid": False}
+    security_id = Column(Integer, primary_key=True)
+    date_int = Column(Integer, primary_key=True)
     dv01 = Column(Float, unique=False, nullable=False)
-    trade_date = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+class Rollup:
+    """
+    Columns shared by the weekly and monthly rollup tables.
+
+    Each row summarises the days of one security in one period: period_int is the
+    date_int of the first day of the week/month, date_int is the last trading day in it
+    and num_days the number of trading days, which lets the mean be updated incrementally
+    """
+
+    __table_args__ = {"sqlite_with_rowid": False}
+    security_id = Column(Integer, primary_key=True)
+    period_int = Column(Integer, primary_key=True)
+    date_int = Column(Integer, unique=False, nullable=False)
+    num_days = Column(Integer, unique=False, nullable=False)
+
+
+class TickHistoryRollup(Rollup):
+    """ytm and close_price summary columns of the tick_history rollups"""
+
+    ytm_last = Column(Float, unique=False, nullable=False)
+    ytm_mean = Column(Float, unique=False, nullable=False)
+    ytm_min = Column(Float, unique=False, nullable=False)
+    ytm_max = Column(Float, unique=False, nullable=False)
+    close_price_last = Column(Float, unique=False, nullable=False)
+    close_price_mean = Column(Float, unique=False, nullable=False)
+    close_price_min = Column(Float, unique=False, nullable=False)
+    close_price_max = Column(Float, unique=False, nullable=False)
+
+
+class DV01Rollup(Rollup):
+    """dv01 summary columns of the dv01_info rollups"""
+
+    dv01_last = Column(Float, unique=False, nullable=False)
+    dv01_mean = Column(Float, unique=False, nullable=False)
+    dv01_min = Column(Float, unique=False, nullable=False)
+    dv01_max = Column(Float, unique=False, nullable=False)
+
+
+class TickHistoryWeekly(TickHistoryRollup, Base):
+    """tick_history_weekly SQL Table schema, the weekly rollup of tick_history"""
+
+    __tablename__ = "tick_history_weekly"
+
+
+class TickHistoryMonthly(TickHistoryRollup, Base):
+    """tick_history_monthly SQL Table schema, the monthly rollup of tick_history"""
+
+    __tablename__ = "tick_history_monthly"
+
+
+class DV01Weekly(DV01Rollup, Base):
+    """dv01_info_weekly SQL Table schema, the weekly rollup of dv01_info"""
+
+    __tablename__ = "dv01_info_weekly"
+
+
+class DV01Monthly(DV01Rollup, Base):
+    """dv01_info_monthly SQL Table schema, the monthly rollup of dv01_info"""
+
+    __tablename__ = "dv01_info_monthly"
+
+
+# pandas period frequency of each rollup resolution
+ROLLUP_FREQS = {"weekly": "W", "monthly": "M"}
+
+# calendar days covered by one point of each resolution, finest first
+RESOLUTION_DAYS = {"daily": 7 / 5, "weekly": 7, "monthly": 365 / 12}
+
+# the charts take up 60% of the page, a few hundred points is enough to fill them
+CHART_POINTS = 300
+
+
+def dates_to_ints(dates: pd.Series) -> pd.Series:
+    """converts a series of dates to integer day numbers"""
+    return (pd.to_datetime(dates) - EPOCH).dt.days
+
+
+def ints_to_dates(date_ints: pd.Series) -> pd.Series:
+    """converts a series of integer day numbers back to dates"""
+    return EPOCH + pd.to_timedelta(date_ints, unit="D")
+
+
+def date_to_int(date: str) -> int:
+    """converts a single date (such as the date picker values) to an integer day number"""
+    return (pd.Timestamp(date) - EPOCH).days
+
+
+def period_ints(date_ints: pd.Series, resolution: str) -> pd.Series:
+    """integer day number of the first day of the week/month each day falls in"""
+    periods = ints_to_dates(date_ints).dt.to_period(ROLLUP_FREQS[resolution])
+    return dates_to_ints(periods.dt.start_time)
+
+
+def choose_resolution(
+    start_date: str, end_date: str, chart_points: int = CHART_POINTS
+) -> str:
+    """the coarsest resolution that still gives a chart at least chart_points points
+    over the date range, falling back to daily for short ranges"""
+    num_days = date_to_int(end_date) - date_to_int(start_date) + 1
+    resolution = "daily"
+    for name, days_per_point in RESOLUTION_DAYS.items():
+        if num_days / days_per_point >= chart_points:
+            resolution = name
+    return resolution
+
+
+def aggregate_rollup(
+    daily_df: pd.DataFrame, columns: list[str], resolution: str
+) -> pd.DataFrame:
+    """summarises daily (security_id, date_int) rows into one row per security and period"""
+    daily_df = daily_df.sort_values(["security_id", "date_int"]).copy()
+    daily_df["period_int"] = period_ints(daily_df["date_int"], resolution)
+    aggregations = {
+        "date_int": ("date_int", "max"),
+        "num_days": ("date_int", "size"),
+    }
+    for column in columns:
+        aggregations[f"{column}_last"] = (column, "last")
+        aggregations[f"{column}_mean"] = (column, "mean")
+        aggregations[f"{column}_min"] = (column, "min")
+        aggregations[f"{column}_max"] = (column, "max")
+    return daily_df.groupby(["security_id", "period_int"]).agg(**aggregations)
+
+
+def merge_rollups(
+    old_df: pd.DataFrame, new_df: pd.DataFrame, columns: list[str]
+) -> pd.DataFrame:
+    """combines two sets of rollup rows for the same periods (covering different days)"""
+    if old_df.empty:
+        return new_df
+    combined = pd.concat([old_df, new_df]).sort_values("date_int")
+    for column in columns:
+        combined[f"{column}_mean"] *= combined["num_days"]
+    aggregations = {"date_int": "max", "num_days": "sum"}
+    for column in columns:
+        aggregations[f"{column}_last"] = "last"
+        aggregations[f"{column}_mean"] = "sum"
+        aggregations[f"{column}_min"] = "min"
+        aggregations[f"{column}_max"] = "max"
+    merged = combined.groupby(level=["security_id", "period_int"]).agg(aggregations)
+    for column in columns:
+        merged[f"{column}_mean"] /= merged["num_days"]
+    return merged
+
+
+def update_rollups(
+    engine: Engine, daily_df: pd.DataFrame, table_name: str, columns: list[str]
+) -> None:
+    """
+    Folds newly landed days into the weekly and monthly rollups of table_name.
+
+    daily_df holds the new (security_id, date_int) rows only. Only the periods those days
+    fall in are read back, merged and rewritten, so a nightly update touches one row
+    per security and resolution rather than rebuilding the rollups from the daily table.
+    """
+    if daily_df.empty:
+        return
+    daily_df = daily_df.reset_index()
+    with engine.begin() as conn:
+        for resolution in ROLLUP_FREQS:
+            rollup_table = f"{table_name}_{resolution}"
+            new_df = aggregate_rollup(daily_df, columns, resolution)
+
+            old_df = pd.read_sql(
+                f"""select * from {rollup_table} where
+                period_int >= {new_df.index.get_level_values("period_int").min()}""",
+                conn,
+                index_col=["security_id", "period_int"],
+            )
+            old_df = old_df[old_df.index.isin(new_df.index)]
+            merged = merge_rollups(old_df, new_df, columns)
+
+            if not old_df.empty:
+                conn.execute(
+                    text(
+                        f"""delete from {rollup_table} where
+                        security_id = :security_id and period_int = :period_int"""
+                    ),
+                    [
+                        {"security_id": int(sec_id), "period_int": int(period_int)}
+                        for sec_id, period_int in old_df.index
+                    ],
+                )
+            merged.to_sql(rollup_table, con=conn, if_exists="append", index=True)
 
 
 def create_database() -> Engine:
-    """instantiates a database with the SQL schema given above"""
+    """instantiates a database with the SQL schema given above.
+    Tables that already exist are kept so that new days are appended to them
+    (delete the database file to rebuild it from scratch)"""
     engine = create_engine(DATABASE_URL)
 
     Base.metadata.create_all(engine)
@@ -85,7 +303,6 @@ def load_refinitiv_data() -> [pd.DataFrame, pd.DataFrame]:
     tick_history = pd.read_csv(
         "refinitiv_data/tick_history.csv", parse_dates=["trade_date"]
     )
-    tick_history.index.name = "id"
     cusip_info = pd.read_csv(
         "refinitiv_data/cusip_info.csv", parse_dates=["maturity_date"]
     )
@@ -93,18 +310,88 @@ def load_refinitiv_data() -> [pd.DataFrame, pd.DataFrame]:
     return tick_history, cusip_info
 
 
+def create_securities(cusips: pd.Series, first_id: int = 1) -> pd.DataFrame:
+    """assigns an integer surrogate id to every distinct CUSIP, counting from first_id"""
+    securities = pd.DataFrame({"cusip": sorted(cusips.unique())})
+    securities.index = securities.index + first_id
+    securities.index.name = "security_id"
+    return securities
+
+
+def update_securities(engine: Engine, cusips: pd.Series) -> pd.DataFrame:
+    """adds the CUSIPs that are not in the securities table yet, keeping the ids of the
+    existing ones, and returns the whole table"""
+    securities = pd.read_sql(
+        "select security_id, cusip from securities", engine, index_col="security_id"
+    )
+    new_cusips = cusips[~cusips.isin(securities["cusip"])]
+    if new_cusips.empty:
+        return securities
+
+    first_id = int(securities.index.max()) + 1 if len(securities) else 1
+    new_securities = create_securities(new_cusips, first_id)
+    with engine.begin() as conn:
+        new_securities.to_sql("securities", con=conn, if_exists="append", index=True)
+    if securities.empty:
+        return new_securities
+    return pd.concat([securities, new_securities])
+
+
+def encode_securities(df: pd.DataFrame, securities: pd.DataFrame) -> pd.DataFrame:
+    """replaces the cusip and trade_date columns with security_id and date_int
+    so the dataframe matches the compact fact table layout"""
+    security_ids = pd.Series(securities.index, index=securities["cusip"])
+    df = df.copy()
+    df["security_id"] = df.pop("cusip").map(security_ids)
+    df["date_int"] = dates_to_ints(df.pop("trade_date"))
+    return df.set_index(["security_id", "date_int"])
+
+
 def insert_data(engine: Engine, df: pd.DataFrame, table_name: str) -> None:
-    """inserts pandas dataframe into SQL database"""
-    conn = engine.connect()
-    df.to_sql(table_name, con=conn, if_exists="replace", index=True)
+    """inserts pandas dataframe into SQL database, replacing the rows of the table
+    while keeping the schema (keys and storage options) created by create_database"""
+    with engine.begin() as conn:
+        conn.execute(text(f"delete from {table_name}"))
+        df.to_sql(table_name, con=conn, if_exists="append", index=True)
+
+
+def append_new_days(engine: Engine, df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    """inserts the (security_id, date_int) rows of df that are not in the table yet
+    and returns them, so they can be folded into the rollups"""
+    if df.empty:
+        return df
+    with engine.begin() as conn:
+        existing = pd.read_sql(
+            f"""select security_id, date_int from {table_name}
+            where date_int >= {df.index.get_level_values("date_int").min()}""",
+            conn,
+            index_col=["security_id", "date_int"],
+        )
+        new_df = df[~df.index.isin(existing.index)]
+        new_df.to_sql(table_name, con=conn, if_exists="append", index=True)
+    return new_df
 
 
 def main() -> None:
-    """create SQL db, load data, and insert data into SQL db"""
+    """create SQL db, load data, and insert data into SQL db.
+
+    Only the days that are not in tick_history yet are inserted and folded into its
+    rollups, so rerunning this as new Refinitiv data lands keeps the existing days
+    (and the DV01 already calculated for them)"""
     engine = create_database()
     tick_history, cusip_info = load_refinitiv_data()
-    insert_data(engine, tick_history, "tick_history")
+
+    tick_history, solver_stats = reconcile_ticks(tick_history, cusip_info)
+    print(f"tick_history reconciliation: {solver_stats}")
+    securities = update_securities(
+        engine, pd.concat([tick_history["cusip"], cusip_info.index.to_series()])
+    )
     insert_data(engine, cusip_info, "cusip_info")
+    tick_history = append_new_days(
+        engine, encode_securities(tick_history, securities), "tick_history"
+    )
+    print(f"{len(tick_history)} new tick_history rows")
+    update_rollups(engine, tick_history, "tick_history", ["ytm", "close_price"])
 
 
 if __name__ == "__main__":
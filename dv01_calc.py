@@ -1,73 +1,81 @@
 """
 Queries the yield data from the SQL database and computes the DVO1 of each bond for each day.
 
-That data is then inserted into the DV01_info table in the SQL database
+That data is then inserted into the DV01_info table in the SQL database.
+Only the days that do not have a DV01 yet are calculated, so the script can be rerun
+as new days land in tick_history
 """
 
-import math
-
 import numpy as np
-import numpy_financial as npf  # pylint: disable=import-error
 import pandas as pd
+from sqlalchemy import create_engine
 
-from database_creation import DATABASE_URL
-
-
-def num_payments_left(date: pd.Timestamp, mat_date: pd.Timestamp, freq: int = 1) -> int:
-    """determines the number of payments left which is necessary for calculating DV01"""
-    if date > mat_date:
-        raise ValueError("date must be before maturity date")
-
-    days = (mat_date - date).days
-    years = days / 365
-    num_payments = int(math.ceil(years) * freq)
-
-    if num_payments == round(num_payments):
-        # if the date, landed on a coupon date
-        num_payments += 1
-    return num_payments
+from bond_pricing import bond_price
+from database_creation import DATABASE_URL, ints_to_dates, update_rollups
 
 
 def calc_dv01(
-    ytm: float,
-    coupon: float,
-    num_payments: int,
+    ytm: np.ndarray,
+    coupon: np.ndarray,
+    years: np.ndarray,
+    freq: np.ndarray | int = 1,
     yield_change: float = 0.01,
-    fv=1000,
-) -> float:
+) -> np.ndarray:
     """DV01 is a linear approximation of duration (the derivative of the present value function).
     DV01 is thus calculated by observing the change in present value of a bond
     if the yield is changed +/-0.01.  The slope of the line is the duration.
+
+    The present values come from bond_pricing.bond_price, the same cash flows that are
+    used to reconcile the yields and prices in tick_history, and whole arrays of
+    bond-days are calculated at once.
     """
-    price = -1 * npf.pv(rate=ytm, nper=num_payments, pmt=coupon, fv=fv)
-    lower = -1 * npf.pv(rate=ytm - yield_change, nper=num_payments, pmt=coupon, fv=fv)
-    higher = -1 * npf.pv(rate=ytm + yield_change, nper=num_payments, pmt=coupon, fv=fv)
+    price = bond_price(ytm, coupon, years, freq)
+    lower = bond_price(ytm - yield_change, coupon, years, freq)
+    higher = bond_price(ytm + yield_change, coupon, years, freq)
     dv01 = (lower - higher) / (2 * price * yield_change)
     return dv01
 
 
 def main():
-    """calculate the dv01_info table and insert it into the SQL database"""
-
-    yield_df = pd.read_sql("tick_history", DATABASE_URL).set_index("id")
-    coupon_df = pd.read_sql("cusip_info", DATABASE_URL).set_index("cusip")
-
-    yield_df["ytm"] = yield_df["ytm"] / 100
-
-    dv01_df = yield_df[["cusip", "trade_date"]].copy()
-    dv01_df["dv01"] = np.nan
-
-    # iterate through every row and calculate the dv01 for each
-    for id_row in yield_df.index:
-        cusip = yield_df.loc[id_row, "cusip"]
-        ytm = yield_df.loc[id_row, "ytm"]
-        trade_date = yield_df.loc[id_row, "trade_date"]
-        coupon = coupon_df.loc[cusip, "coupon"]
-        maturity_date = coupon_df.loc[cusip, "maturity_date"]
-        num_payments = num_payments_left(trade_date, maturity_date)
-        dv01_df.loc[id_row, "dv01"] = calc_dv01(ytm, coupon, num_payments)
+    """calculate the dv01 of the days not yet in the dv01_info table, insert them
+    into the SQL database and fold them into the dv01_info rollups"""
+
+    engine = create_engine(DATABASE_URL)
+    yield_df = pd.read_sql(
+        """select t.security_id, t.date_int, t.ytm from tick_history t
+        left join dv01_info d
+        on d.security_id = t.security_id and d.date_int = t.date_int
+        where d.dv01 is null""",
+        engine,
+    )
+    coupon_df = pd.read_sql(
+        """select s.security_id, c.coupon, c.coupon_freq, c.maturity_date
+        from cusip_info c join securities s on s.cusip = c.cusip""",
+        engine,
+        parse_dates=["maturity_date"],
+    ).set_index("security_id")
+
+    bonds = coupon_df.reindex(yield_df["security_id"])
+    trade_dates = ints_to_dates(yield_df["date_int"]).to_numpy()
+    years = (
+        (bonds["maturity_date"].to_numpy() - trade_dates)
+        / np.timedelta64(1, "D")
+        / 365
+    )
+    if (years < 0).any():
+        raise ValueError("date must be before maturity date")
 
-    dv01_df.to_sql("dv01_info", DATABASE_URL, if_exists="replace", index=True)
+    dv01_df = yield_df[["security_id", "date_int"]].copy()
+    dv01_df["dv01"] = calc_dv01(
+        yield_df["ytm"].to_numpy() / 100,
+        bonds["coupon"].to_numpy(dtype=float),
+        years,
+        bonds["coupon_freq"].to_numpy(dtype=float),
+    )
+
+    dv01_df = dv01_df.set_index(["security_id", "date_int"])
+    dv01_df.to_sql("dv01_info", engine, if_exists="append", index=True)
+    update_rollups(engine, dv01_df, "dv01_info", ["dv01"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+"""
+Compares the file size and query latency of the original tick_history and dv01_info
+layout (a String cusip and DateTime trade_date repeated on every row) against the
+compact layout in database_creation.py (integer security_id and date_int keys) on a
+large synthetic universe of bonds.
+
+Example:
+    poetry run python schema_benchmark.py --num-cusips 2000 --num-days 2520
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from database_creation import (
+    Base,
+    create_securities,
+    date_to_int,
+    encode_securities,
+    insert_data,
+)
+
+
+def synthetic_tick_history(
+    num_cusips: int, num_days: int, seed: int = 0
+) -> pd.DataFrame:
+    """random walk yields and prices for num_cusips bonds over num_days business days"""
+    rng = np.random.default_rng(seed)
+    cusips = [f"{i:08d}X" for i in range(num_cusips)]
+    dates = pd.bdate_range(end="2023-12-18", periods=num_days)
+    ytm = 4 + np.cumsum(rng.normal(0, 0.05, (num_cusips, num_days)), axis=1)
+    close_price = 100 + np.cumsum(rng.normal(0, 0.3, (num_cusips, num_days)), axis=1)
+    return pd.DataFrame(
+        {
+            "trade_date": np.tile(dates, num_cusips),
+            "cusip": np.repeat(cusips, num_days),
+            "ytm": ytm.ravel(),
+            "close_price": close_price.ravel(),
+        }
+    )
+
+
+def synthetic_dv01(tick_history: pd.DataFrame, seed: int = 1) -> pd.DataFrame:
+    """random walk dv01 for the same bond-days as tick_history"""
+    rng = np.random.default_rng(seed)
+    num_cusips = tick_history["cusip"].nunique()
+    num_days = len(tick_history) // num_cusips
+    dv01 = 8 + np.cumsum(rng.normal(0, 0.01, (num_cusips, num_days)), axis=1)
+    return pd.DataFrame(
+        {
+            "cusip": tick_history["cusip"],
+            "dv01": dv01.ravel(),
+            "trade_date": tick_history["trade_date"],
+        }
+    )
+
+
+def create_original_layout(
+    path: str, tick_history: pd.DataFrame, dv01_info: pd.DataFrame
+) -> None:
+    """writes tick_history and dv01_info the way the original ingestion and dv01_calc did"""
+    for table_name, df in [("tick_history", tick_history), ("dv01_info", dv01_info)]:
+        df = df.copy()
+        df.index.name = "id"
+        df.to_sql(table_name, f"sqlite:///{path}", if_exists="replace", index=True)
+
+
+def create_compact_layout(
+    path: str, tick_history: pd.DataFrame, dv01_info: pd.DataFrame
+) -> None:
+    """writes tick_history and dv01_info with the securities dimension and integer keys"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    securities = create_securities(tick_history["cusip"])
+    insert_data(engine, securities, "securities")
+    insert_data(engine, encode_securities(tick_history, securities), "tick_history")
+    insert_data(engine, encode_securities(dv01_info, securities), "dv01_info")
+
+
+def time_query(path: str, query: str, repeats: int) -> tuple[float, int]:
+    """median wall time in milliseconds of reading the query into a dataframe,
+    and the number of rows it returned"""
+    engine = create_engine(f"sqlite:///{path}")
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        num_rows = len(pd.read_sql(query, engine))
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings)), num_rows
+
+
+def main() -> None:
+    """build both layouts, then report their file sizes and callback query latencies"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--num-cusips", type=int, default=1000)
+    parser.add_argument("--num-days", type=int, default=1260)
+    parser.add_argument("--num-selected", type=int, default=5)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    tick_history = synthetic_tick_history(args.num_cusips, args.num_days)
+    dv01_info = synthetic_dv01(tick_history)
+    secs = tuple(tick_history["cusip"].unique()[: args.num_selected])
+    start_date = tick_history["trade_date"].iloc[-args.num_days // 2]
+    end_date = tick_history["trade_date"].iloc[-1]
+
+    # the same queries the yield and dv01 callbacks run, in each layout. The original
+    # trade_date is stored as 'YYYY-MM-DD 00:00:00.000000', so the end of the range is
+    # compared with the start of the next day to keep end_date itself
+    queries = {}
+    for table_name, column in [("tick_history", "ytm"), ("dv01_info", "dv01")]:
+        queries[table_name] = {
+            "original": f"""select cusip, {column}, trade_date from {table_name} where
+            trade_date >= '{start_date.date()}'
+            and trade_date < '{(end_date + pd.Timedelta(days=1)).date()}'
+            and cusip in {secs}""",
+            "compact": f"""select s.cusip, t.{column}, t.date_int as trade_date
+            from {table_name} t join securities s on s.security_id = t.security_id
+            where t.date_int >= {date_to_int(start_date)}
+            and t.date_int <= {date_to_int(end_date)} and s.cusip in {secs}""",
+        }
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for layout, create_layout in [
+            ("original", create_original_layout),
+            ("compact", create_compact_layout),
+        ]:
+            path = os.path.join(tmp_dir, f"{layout}.db")
+            start = time.perf_counter()
+            create_layout(path, tick_history, dv01_info)
+            result = {
+                "layout": layout,
+                "rows": len(tick_history) + len(dv01_info),
+                "ingest_s": round(time.perf_counter() - start, 2),
+                "size_mb": round(os.path.getsize(path) / 1e6, 1),
+            }
+            for table_name, layout_queries in queries.items():
+                query_ms, num_rows = time_query(
+                    path, layout_queries[layout], args.repeats
+                )
+                result[f"{table_name}_query_ms"] = round(query_ms, 1)
+                result[f"{table_name}_query_rows"] = num_rows
+            results.append(result)
+
+    results_df = pd.DataFrame(results).set_index("layout")
+    for table_name in queries:
+        # both layouts must return the same rows for the latencies to be comparable
+        num_rows = results_df[f"{table_name}_query_rows"]
+        assert num_rows.nunique() == 1, f"{table_name} row counts differ: {num_rows}"
+    print(results_df.to_string())
+
+
+if __name__ == "__main__":
+    main()
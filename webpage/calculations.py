@@ -4,13 +4,24 @@ This module contains functions for:
 - calcuating the daily yield change
 - computing historical simulation VaR
 - computing variance-covariance VaR
+- caching constituent return means/covariances so parametric VaR is a w'Σw evaluation
+
+Both VaRs are of the daily percentage change of the portfolio yield series from
+create_portfolio. That change is Σ(wᵢyᵢ/Σwⱼyⱼ)·rᵢ, where rᵢ are the constituent changes
+and yᵢ the constituent yields of the previous day. The historical simulation uses those
+weights for every day, so it matches the portfolio series exactly; the
+variance-covariance VaR holds them at the yields of the last day so that it is w'Σw
 """
 import json
+import threading
+from collections import deque
 
 import numpy as np
 import pandas as pd
 from scipy.stats import norm
 
+from database_creation import ints_to_dates
+
 
 def create_portfolio(
     input_df: pd.DataFrame, table_data: dict, column: str = "ytm"
@@ -47,20 +58,259 @@ def value_at_risk_historical_simulation(
     yield_df: pd.DataFrame, table_data: list[dict], confidence_level=0.99
 ) -> float:
     """compute the historical simulation VaR of the portfolio"""
-    port_df = create_portfolio(yield_df, table_data)
-    returns = port_df["Portfolio"].pct_change()
-    value_at_risk = returns.quantile(1 - confidence_level)
-    return value_at_risk
+    port_df = constituent_yields(yield_df)
+    estimator = CovarianceEstimator.from_returns(pivot_returns(port_df), None, port_df)
+    return estimator.historical_value_at_risk(table_data, confidence_level)
 
 
 def value_at_risk_var_covar(
     yield_df: pd.DataFrame, table_data: list[dict], confidence_level=0.99
 ) -> float:
     """compute the variance-covariance VaR of the portfolio"""
-    port_df = create_portfolio(yield_df, table_data)
-    returns = port_df["Portfolio"].pct_change()
-    value_at_risk = norm.ppf(1 - confidence_level, returns.mean(), returns.std())
-    return value_at_risk
+    port_df = constituent_yields(yield_df)
+    estimator = CovarianceEstimator.from_returns(pivot_returns(port_df), None, port_df)
+    return estimator.value_at_risk(table_data, confidence_level)
+
+
+# number of trading days in the lookback windows that are precomputed and cached.
+# None means the whole history that was queried
+LOOKBACK_WINDOWS = {"1M": 21, "3M": 63, "6M": 126, "1Y": 252, "All": None}
+
+
+def constituent_yields(input_df: pd.DataFrame, column: str = "ytm") -> pd.DataFrame:
+    """convert yield data into a columnar dataframe of forward filled yields per cusip,
+    the same constituent columns that create_portfolio weights"""
+    return pd.pivot_table(
+        input_df, index="trade_date", columns="cusip", values=column
+    ).ffill()
+
+
+def constituent_returns(input_df: pd.DataFrame, column: str = "ytm") -> pd.DataFrame:
+    """convert yield data into a columnar dataframe of daily percentage changes per cusip"""
+    return pivot_returns(constituent_yields(input_df, column))
+
+
+def pivot_returns(port_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Daily percentage changes of a (trade_date x cusip) frame.
+
+    A cusip that has not started trading yet has a return of 0 on those days, just as it
+    adds nothing to the create_portfolio series, rather than the day being dropped for
+    every cusip.
+    """
+    return port_df.ffill().pct_change(fill_method=None).iloc[1:].fillna(0.0)
+
+
+class CovarianceEstimator:
+    """
+    Running mean and covariance of the daily constituent returns.
+
+    The estimator only keeps the sum of the returns and the sum of their outer products,
+    so new days are added (and, for a fixed lookback, the oldest days dropped) without
+    rebuilding the time series.  The parametric VaR of any weight vector is then
+    just w'μ and w'Σw, and the marginal and component VaR fall out of Σw.
+
+    Given the constituent yields, the table weights are turned into the weights of the
+    constituent returns (see weights); without them the table weights are used as is.
+    """
+
+    def __init__(self, cusips: list[str], lookback: int | None = None):
+        self.cusips = list(cusips)
+        self.lookback = lookback
+        self.last_date = None
+        self.levels = None
+        self._dates = deque()
+        self._window = deque()
+        self._prev_levels = deque()
+        self._sum = np.zeros(len(self.cusips))
+        self._outer_sum = np.zeros((len(self.cusips), len(self.cusips)))
+
+    @classmethod
+    def from_returns(
+        cls,
+        returns_df: pd.DataFrame,
+        lookback: int | None = None,
+        levels_df: pd.DataFrame | None = None,
+    ) -> "CovarianceEstimator":
+        """build the estimator from a dataframe of daily returns (trade_date x cusip)"""
+        estimator = cls(returns_df.columns, lookback)
+        estimator.update(returns_df, levels_df)
+        return estimator
+
+    @property
+    def num_days(self) -> int:
+        """number of days currently inside the lookback window"""
+        return len(self._window)
+
+    @property
+    def mean(self) -> np.ndarray:
+        """per-cusip mean daily return"""
+        return self._sum / self.num_days
+
+    @property
+    def cov(self) -> np.ndarray:
+        """per-cusip sample covariance matrix of the daily returns"""
+        mean = self.mean
+        return (self._outer_sum - self.num_days * np.outer(mean, mean)) / (
+            self.num_days - 1
+        )
+
+    def update(
+        self, returns_df: pd.DataFrame, levels_df: pd.DataFrame | None = None
+    ) -> None:
+        """add new days of returns, dropping the oldest days once the lookback is full.
+        Days on or before the last day already seen are ignored.
+        levels_df holds the forward filled constituent yields the returns were taken from
+        (including the day before the first return) and is given on every update or never"""
+        returns_df = returns_df[self.cusips]
+        if levels_df is not None:
+            levels_df = levels_df[self.cusips]
+            self.levels = levels_df.iloc[-1].to_numpy(dtype=float)
+            prev_levels = levels_df.shift(1).reindex(returns_df.index)
+        if self.last_date is not None:
+            returns_df = returns_df[returns_df.index > self.last_date]
+        if self.lookback is not None:
+            # earlier days would be dropped again straight away
+            returns_df = returns_df.iloc[-self.lookback :]
+        if returns_df.empty:
+            return
+
+        new_rows = returns_df.to_numpy(dtype=float)
+        if levels_df is not None:
+            self._prev_levels.extend(
+                np.nan_to_num(prev_levels.loc[returns_df.index].to_numpy(dtype=float))
+            )
+        self._dates.extend(returns_df.index)
+        self._window.extend(new_rows)
+        self._sum += new_rows.sum(axis=0)
+        self._outer_sum += new_rows.T @ new_rows
+        self.last_date = returns_df.index[-1]
+
+        num_dropped = 0 if self.lookback is None else self.num_days - self.lookback
+        if num_dropped > 0:
+            for _ in range(num_dropped):
+                self._dates.popleft()
+                if self._prev_levels:
+                    self._prev_levels.popleft()
+            old_rows = np.array([self._window.popleft() for _ in range(num_dropped)])
+            self._sum -= old_rows.sum(axis=0)
+            self._outer_sum -= old_rows.T @ old_rows
+
+    def extends_to(self, returns_df: pd.DataFrame) -> bool:
+        """whether returns_df holds the days already in the window (and maybe newer ones),
+        so that update can bring the estimator up to date instead of rebuilding it"""
+        if not self._dates or returns_df.empty:
+            return False
+        if self.last_date not in returns_df.index:
+            return False
+        if self.lookback is None or self.num_days < self.lookback:
+            return self._dates[0] == returns_df.index[0]
+        return self._dates[0] >= returns_df.index[0]
+
+    def table_weights(self, table_data: list[dict]) -> np.ndarray:
+        """constituents table weights aligned with the cusip order of the covariance matrix"""
+        weights = pd.DataFrame(table_data).set_index("cusip")["weight"].astype(float)
+        return weights.reindex(self.cusips).fillna(0.0).to_numpy()
+
+    def weights(self, table_data: list[dict]) -> np.ndarray:
+        """
+        Weights of the constituent returns in the portfolio return.
+
+        The daily change of the portfolio yield Σwᵢyᵢ is Σ(wᵢyᵢ/Σwⱼyⱼ)·rᵢ with the yields
+        of the previous day, which are held at the yields of the last day here so that the
+        parametric VaR is a single w'Σw.
+        """
+        weights = self.table_weights(table_data)
+        if self.levels is None:
+            return weights
+        exposures = weights * np.nan_to_num(self.levels)
+        return exposures / exposures.sum()
+
+    def historical_value_at_risk(
+        self, table_data: list[dict], confidence_level=0.99
+    ) -> float:
+        """historical simulation VaR of the portfolio over the days in the window,
+        using the weights of each day so the returns are those of the portfolio series"""
+        if self.num_days < 2:
+            return np.nan
+        weights = self.table_weights(table_data)
+        if self.levels is None:
+            returns = np.array(self._window) @ weights
+        else:
+            exposures = np.array(self._prev_levels) * weights
+            returns = (exposures * np.array(self._window)).sum(axis=1) / exposures.sum(
+                axis=1
+            )
+        return np.quantile(returns, 1 - confidence_level)
+
+    def value_at_risk(self, table_data: list[dict], confidence_level=0.99) -> float:
+        """variance-covariance VaR of the portfolio from w'μ and w'Σw"""
+        if self.num_days < 2:
+            return np.nan
+        weights = self.weights(table_data)
+        port_mean = weights @ self.mean
+        port_std = np.sqrt(weights @ self.cov @ weights)
+        return norm.ppf(1 - confidence_level, port_mean, port_std)
+
+    def marginal_value_at_risk(
+        self, table_data: list[dict], confidence_level=0.99
+    ) -> pd.Series:
+        """change in the portfolio VaR per unit of weight added to each constituent"""
+        if self.num_days < 2:
+            return pd.Series(np.nan, index=self.cusips)
+        weights = self.weights(table_data)
+        cov_weights = self.cov @ weights
+        port_std = np.sqrt(weights @ cov_weights)
+        marginal = self.mean + norm.ppf(1 - confidence_level) * cov_weights / port_std
+        return pd.Series(marginal, index=self.cusips)
+
+    def component_value_at_risk(
+        self, table_data: list[dict], confidence_level=0.99
+    ) -> pd.Series:
+        """contribution of each constituent to the portfolio VaR, these sum to the portfolio VaR"""
+        marginal = self.marginal_value_at_risk(table_data, confidence_level)
+        return marginal * self.weights(table_data)
+
+
+# estimators per (cusips, lookback), brought up to date in place as new days arrive.
+# The callbacks run on several threads, so the cache is only touched under the lock
+COVARIANCE_CACHE: dict[tuple, CovarianceEstimator] = {}
+COVARIANCE_CACHE_SIZE = 64
+COVARIANCE_LOCK = threading.Lock()
+
+
+def cached_covariance(
+    returns_df: pd.DataFrame,
+    levels_df: pd.DataFrame,
+    lookback: int | None = None,
+) -> CovarianceEstimator:
+    """
+    Returns the covariance estimator of the lookback window for the constituent returns
+    (and the constituent yields they were taken from).
+
+    The estimators of every window in LOOKBACK_WINDOWS are kept per set of cusips.
+    When the data holds days the cached estimators have not seen, only those days are
+    added to them; they are rebuilt only when the data no longer covers their window
+    (another date range was picked).
+    """
+    cusips = tuple(returns_df.columns)
+    with COVARIANCE_LOCK:
+        for window in LOOKBACK_WINDOWS.values():
+            key = (cusips, window)
+            estimator = COVARIANCE_CACHE.pop(key, None)
+            if estimator is not None and estimator.extends_to(returns_df):
+                estimator.update(returns_df, levels_df)
+            else:
+                estimator = CovarianceEstimator.from_returns(
+                    returns_df, window, levels_df
+                )
+            COVARIANCE_CACHE[key] = estimator
+            if window == lookback:
+                requested = estimator
+
+        while len(COVARIANCE_CACHE) > COVARIANCE_CACHE_SIZE:
+            COVARIANCE_CACHE.pop(next(iter(COVARIANCE_CACHE)))
+    return requested
 
 
 def check_weights(table_data: list[dict]) -> bool:
@@ -75,6 +325,6 @@ def check_weights(table_data: list[dict]) -> bool:
 def convert_to_port_df(port_data: str, column: str = "ytm") -> pd.DataFrame:
     """converts json string to pandas dataframe"""
     port_df = pd.DataFrame(json.loads(port_data))
-    port_df["trade_date"] = pd.to_datetime(port_df["trade_date"])
+    port_df["trade_date"] = ints_to_dates(port_df["trade_date"])
     port_df[column] = port_df[column].astype(float)
     return port_df
@@ -16,14 +16,83 @@ def some func(valueA, valueB):
 """
 
 import json
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
 from dash import Input, Output, Dash
 from plotly.graph_objs import Layout, Scatter
 
-from database_creation import DATABASE_URL
+from database_creation import (
+    DATABASE_URL,
+    aggregate_rollup,
+    choose_resolution,
+    date_to_int,
+    ints_to_dates,
+    period_ints,
+)
 from webpage import calculations as calcs
 
+
+def query_daily_data(
+    table_name: str, column: str, start_int: int, end_int: int, secs: list[str]
+) -> pd.DataFrame:
+    """Queries the daily rows of a column between two integer day numbers"""
+    query = f"""select t.security_id, s.cusip, t.{column}, t.date_int from {table_name} t
+    join securities s on s.security_id = t.security_id where
+    t.date_int >= {start_int} and t.date_int <= {end_int} and s.cusip in {tuple(secs)}"""
+    return pd.read_sql(query, DATABASE_URL)
+
+
+def query_chart_data(
+    table_name: str, column: str, start_date: str, end_date: str, secs: list[str]
+) -> str:
+    """Queries the data for a chart from the coarsest table (daily, weekly or monthly
+    rollup) that still fills the chart over the date range and returns it as a json string.
+    The week or month holding end_date is rolled up from its daily rows up to end_date,
+    so the chart ends on end_date rather than on the last complete period"""
+    resolution = choose_resolution(start_date, end_date)
+    start_int, end_int = date_to_int(start_date), date_to_int(end_date)
+    if resolution == "daily":
+        chart_df = query_daily_data(table_name, column, start_int, end_int, secs)
+    else:
+        start_period, end_period = period_ints(
+            pd.Series([start_int, end_int]), resolution
+        )
+        query = f"""select s.cusip, t.{column}_last as {column}, t.date_int
+        from {table_name}_{resolution} t join securities s on s.security_id = t.security_id
+        where t.period_int >= {start_period} and t.period_int < {end_period}
+        and t.date_int >= {start_int} and s.cusip in {tuple(secs)}"""
+        rollup_df = pd.read_sql(query, DATABASE_URL)
+
+        daily_df = query_daily_data(table_name, column, end_period, end_int, secs)
+        cusips = daily_df.groupby("security_id")["cusip"].first()
+        partial_df = aggregate_rollup(daily_df, [column], resolution).reset_index()
+        partial_df["cusip"] = partial_df["security_id"].map(cusips)
+        partial_df[column] = partial_df[f"{column}_last"]
+        chart_df = pd.concat([rollup_df, partial_df[rollup_df.columns]])
+
+    chart_df = chart_df[["cusip", column, "date_int"]].rename(
+        columns={"date_int": "trade_date"}
+    )
+    return json.dumps(chart_df.to_dict("records"))
+
+
+@lru_cache(maxsize=8)
+def query_var_data(
+    start_date: str, end_date: str, secs: tuple[str]
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Queries the daily yields the VaRs are calculated from and returns the constituent
+    returns and yields. These stay on the server rather than being sent to the page,
+    and are cached so both VaR callbacks and re-weighting the portfolio share one query"""
+    yield_df = query_daily_data(
+        "tick_history", "ytm", date_to_int(start_date), date_to_int(end_date), secs
+    )
+    yield_df["trade_date"] = ints_to_dates(yield_df.pop("date_int"))
+    port_df = calcs.constituent_yields(yield_df)
+    return calcs.pivot_returns(port_df), port_df
+
+
 # this is all wrapped in a function so that it can be imported into main.py
 def get_callbacks(app: Dash):
     """wrapper functioon to assign all the callbacks for the Bond Portfolio tab
@@ -38,11 +107,7 @@ def get_callbacks(app: Dash):
     def query_yield_data(start_date: str, end_date: str, secs: list[str]) -> dict:
         """Callback function to query the SQL database for the yield data
         and return it as a json string"""
-        query = f"""select cusip, ytm, trade_date from tick_history where
-        trade_date >= '{start_date}' and trade_date <= '{end_date}' and cusip in {tuple(secs)}"""
-        yield_df = pd.read_sql(query, DATABASE_URL).to_dict("records")
-
-        return json.dumps(yield_df)
+        return query_chart_data("tick_history", "ytm", start_date, end_date, secs)
 
     @app.callback(
         Output("hidden-dv01-data", "children"),
@@ -53,10 +118,7 @@ def get_callbacks(app: Dash):
     def query_dv01_data(start_date: str, end_date: str, secs: list[str]) -> dict:
         """Callback function to query the SQL database for the dv01 data
         and return it as a json string"""
-        query = f"""select cusip, dv01, trade_date from dv01_info where
-        trade_date >= '{start_date}' and trade_date <= '{end_date}' and cusip in {tuple(secs)}"""
-        dv01_df = pd.read_sql(query, DATABASE_URL).to_dict("records")
-        return json.dumps(dv01_df)
+        return query_chart_data("dv01_info", "dv01", start_date, end_date, secs)
 
     @app.callback(
         Output("hidden-price-data", "children"),
@@ -67,10 +129,9 @@ def get_callbacks(app: Dash):
     def query_price_data(start_date: str, end_date: str, secs: list[str]) -> dict:
         """Callback function to query the SQL database for the yield data
         and return it as a json string"""
-        query = f"""select cusip, close_price, trade_date from tick_history where
-        trade_date >= '{start_date}' and trade_date <= '{end_date}' and cusip in {tuple(secs)}"""
-        price_df = pd.read_sql(query, DATABASE_URL).to_dict("records")
-        return json.dumps(price_df)
+        return query_chart_data(
+            "tick_history", "close_price", start_date, end_date, secs
+        )
 
 
     @app.callback(
@@ -170,8 +231,15 @@ def get_callbacks(app: Dash):
         Output(component_id="yield-change-graph", component_property="figure"),
         Input("hidden-port-data", "children"),
         Input("constituents-table", "data"),
+        Input("date-range", "start_date"),
+        Input("date-range", "end_date"),
     )
-    def create_yield_change_chart(port_data: dict, table_data: dict) -> dict:
+    def create_yield_change_chart(
+        port_data: dict, table_data: dict, start_date: str, end_date: str
+    ) -> dict:
+        # the change between consecutive points of the yield chart, so over long date
+        # ranges it is the weekly or monthly change of the rollups
+        resolution = choose_resolution(start_date, end_date)
         sec_df = calcs.convert_to_port_df(port_data)
         delta_df = calcs.create_yield_change_df(sec_df, table_data)
         traces = [
@@ -185,7 +253,7 @@ def get_callbacks(app: Dash):
             )
         ]
         layout = Layout(
-            title="Portfolio Daily Yield Change",
+            title=f"Portfolio {resolution.capitalize()} Yield Change",
             yaxis={"title": "Yield Delta"},
             hovermode="closest",
             legend=dict(x=0, y=1),
@@ -230,28 +298,57 @@ def get_callbacks(app: Dash):
 
     @app.callback(
         Output(component_id="sim-var", component_property="children"),
-        Input("hidden-port-data", "children"),
+        Input("date-range", "start_date"),
+        Input("date-range", "end_date"),
+        Input(component_id="sec-picker", component_property="value"),
         Input("constituents-table", "data"),
         Input("var-slider", "value"),
+        Input("var-lookback", "value"),
     )
-    def create_sim_value_at_risk(port_data: dict, table_data: dict) -> dict:
-        sec_df = calcs.convert_to_port_df(port_data)
-        var = calcs.value_at_risk_historical_simulation(
-            sec_df, table_data, confidence_level / 100
+    def create_sim_value_at_risk(
+        start_date: str,
+        end_date: str,
+        secs: list[str],
+        table_data: dict,
+        confidence_level: int,
+        lookback: str,
+    ) -> dict:
+        returns_df, levels_df = query_var_data(start_date, end_date, tuple(secs))
+        estimator = calcs.cached_covariance(
+            returns_df, levels_df, calcs.LOOKBACK_WINDOWS[lookback]
         )
+        var = estimator.historical_value_at_risk(table_data, confidence_level / 100)
         if calcs.check_weights(table_data):
             return f"Historical Simulation VaR: {var:.2%}"
         return "Historical Simulation VaR:"
 
     @app.callback(
         Output(component_id="cov-var", component_property="children"),
-        Input("hidden-port-data", "children"),
+        Output(component_id="cov-var-components", component_property="children"),
+        Input("date-range", "start_date"),
+        Input("date-range", "end_date"),
+        Input(component_id="sec-picker", component_property="value"),
         Input("constituents-table", "data"),
         Input("var-slider", "value"),
+        Input("var-lookback", "value"),
     )
-    def create_var_cov_value_at_risk(port_data, table_data, confidence_level):
-        sec_df = calcs.convert_to_port_df(port_data)
-        var = calcs.value_at_risk_var_covar(sec_df, table_data, confidence_level / 100)
-        if calcs.check_weights(table_data):
-            return f"Variance-Covariance VaR: {var:.2%}"
-        return "Variance-Covariance VaR:"
+    def create_var_cov_value_at_risk(
+        start_date, end_date, secs, table_data, confidence_level, lookback
+    ):
+        # the covariance matrix is cached per cusips and lookback so re-weighting is only w'Σw
+        returns_df, levels_df = query_var_data(start_date, end_date, tuple(secs))
+        estimator = calcs.cached_covariance(
+            returns_df, levels_df, calcs.LOOKBACK_WINDOWS[lookback]
+        )
+        var = estimator.value_at_risk(table_data, confidence_level / 100)
+        if not calcs.check_weights(table_data):
+            return "Variance-Covariance VaR:", ""
+        if np.isnan(var):
+            # fewer than two days in the window
+            return f"Variance-Covariance VaR: {var:.2%}", ""
+        components = estimator.component_value_at_risk(
+            table_data, confidence_level / 100
+        )
+        return f"Variance-Covariance VaR: {var:.2%}", ", ".join(
+            f"{cusip}: {value:.2%}" for cusip, value in components.items()
+        )
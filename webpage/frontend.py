@@ -9,6 +9,9 @@ import pandas as pd
 from dash import dcc, html  # pylint: disable=import-error
 from dash.dash_table import DataTable  # pylint: disable=import-error
 
+from database_creation import ints_to_dates
+from webpage.calculations import LOOKBACK_WINDOWS
+
 styling = {
     "font-family": "Georgia",
     "font-size": "18px",
@@ -32,10 +35,11 @@ CUSIPS = CUSIPS.rename(columns={"cusip": "label"})
 CUSIPS = CUSIPS.to_dict("records")
 
 DATES = pd.read_sql(
-    f"select trade_date from tick_history where cusip='{CUSIPS[0]['label']}'",
+    f"""select t.date_int from tick_history t join securities s
+    on s.security_id = t.security_id where s.cusip='{CUSIPS[0]['label']}'""",
     DATABASE_URL,
 )
-DATES["trade_date"] = pd.to_datetime(DATES["trade_date"])
+DATES["trade_date"] = ints_to_dates(DATES["date_int"])
 MAX_DATE = DATES["trade_date"].max()
 MAX_DATE = date(MAX_DATE.year, MAX_DATE.month, MAX_DATE.day)
 MIN_DATE = DATES["trade_date"].min()
@@ -139,11 +143,26 @@ def load_html() -> html.Div:
                     ),
                     html.Label("VaR Confidence Interval %", style=styling),
                     dcc.Slider(min=90, max=99, step=1, value=95, id="var-slider"),
+                    html.Label("VaR Lookback Window", style=styling),
+                    dcc.Dropdown(
+                        options=list(LOOKBACK_WINDOWS),
+                        value="All",
+                        clearable=False,
+                        id="var-lookback",
+                        style={"textAlign": "center", "align": "center"},
+                    ),
                     html.Label("VaR Type", style=styling),
+                    html.Label(
+                        "Both VaRs are of the daily % change of the portfolio yield",
+                        style=styling_table,
+                    ),
                     html.Label(
                         "Historical Simulation VaR:", style=styling, id="sim-var"
                     ),
                     html.Label("Variance-Covariance VaR:", style=styling, id="cov-var"),
+                    html.Label(
+                        "", style=styling_table, id="cov-var-components"
+                    ),
                     DataTable(
                         id="constituents-table",
                         columns=(